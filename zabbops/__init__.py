@@ -4,7 +4,8 @@ AWS EC2 and Lambda APIs (boto).
 """
 
 from .configurator import Configurator
-from .transform import get_tag_by_key, tag_to_macro, instance_to_host
-from .handlers import KinesisStreamHandler
+from .transform import get_tag_by_key, tag_to_macro, instance_to_host, select_proxy
+from .handlers import KinesisStreamHandler, EC2StateChangeHandler, FlushHandler
+from .journal import Journal
 
 __version__ = '1.0.0'
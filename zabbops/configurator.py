@@ -1,4 +1,4 @@
-from .transform import instance_to_host, host_diff
+from .transform import instance_to_host, host_diff, select_proxy
 
 RFC_2822 = '%a, %d %b %Y %T %z'
 
@@ -8,24 +8,45 @@ class Configurator(object):
     to update Zabbix configuration, using AWS API objects as input.
     """
 
-    def __init__(self, api=None):
+    def __init__(self, api=None, proxies=None, proxy_affinity=None, proxy_tolerance=0.2,
+                 proxy_ttl=60, journal=None):
+        """
+        If a pool of Zabbix Proxies is given, each Host is assigned to a Proxy
+        from the pool. Each Proxy may be given by name, or as a dict with a
+        'host' name and optional 'availability_zone' or 'vpc_id' used to
+        filter eligible Proxies by proxy_affinity ('az' or 'vpc'). See
+        select_proxy for the meaning of proxy_tolerance. Proxy host counts are
+        refreshed from Zabbix every proxy_ttl seconds.
+
+        If a write-behind Journal is given, upsert_host records the desired
+        state of each Host in the journal and changes are sent to Zabbix in
+        bulk by flush.
+        """
+
         from logging import getLogger
         from os import environ
-        from pyzabbix import ZabbixAPI
 
         self._api = api
+        self._proxies = proxies or []
+        self._proxy_affinity = proxy_affinity
+        self._proxy_tolerance = proxy_tolerance
+        self._proxy_ttl = proxy_ttl
+        self._journal = journal
 
         # memoizing cache (no lifetime management)
         self._cache = {
             'hosts': {},
             'hostids': {},
             'groupids': {},
-            'templateids': {}
+            'templateids': {},
+            'proxies': None
         }
 
         self.logger = getLogger('zabbops')
 
         if not self._api:
+            from pyzabbix import ZabbixAPI
+
             # connect using environment variables
             config = {}
             keys = [key for key in environ if key.startswith('ZABBIX_')]
@@ -137,6 +158,86 @@ class Configurator(object):
         self.logger.debug('Looked up templateid for \'%s\': %s', template_name, templateid)
         return templateid
 
+    def get_proxies(self):
+        """
+        Returns the configured pool of Zabbix Proxies, keyed by Proxy ID, with
+        the number of Hosts currently monitored by each Proxy. Host counts are
+        cached for proxy_ttl seconds, as other Configurators may assign Hosts
+        to the same Proxies.
+        """
+
+        from time import time
+
+        # cache expires, so that counts do not drift across warm invocations
+        now = time()
+        if self._cache['proxies'] is not None and self._cache['proxies'][0] > now:
+            return self._cache['proxies'][1]
+
+        pool = {}
+        for proxy in self._proxies:
+            if not isinstance(proxy, dict):
+                proxy = {'host': proxy}
+            pool[proxy['host']] = proxy
+
+        # fetch all proxies and their host counts in a single request
+        response = self._api.do_request('proxy.get', {
+            'filter': {'host': list(pool)},
+            'output': ['proxyid', 'host'],
+            'selectHosts': ['hostid'],
+        })
+
+        proxies = {}
+        for result in response['result']:
+            proxy = dict(pool.pop(result['host']))
+            proxy['proxyid'] = result['proxyid']
+            proxy['hosts'] = len(result['hosts'])
+            proxies[proxy['proxyid']] = proxy
+
+        for name in pool:
+            self.logger.warning('Zabbix Proxy not found: %s', name)
+
+        # an empty pool is cached too, to avoid a lookup for every host
+        self._cache['proxies'] = (now + self._proxy_ttl, proxies)
+        self.logger.debug('Looked up %d proxies', len(proxies))
+        return proxies
+
+    def assign_proxy(self, instance, current=None):
+        """
+        Returns the ID of the Zabbix Proxy that should monitor the given AWS EC2
+        Instance, '0' if no Proxy in the pool is eligible, or None if no Proxy
+        pool is configured or none of its Proxies exist in Zabbix. The given
+        current Proxy ID is retained unless the pool is unbalanced.
+        """
+
+        if not self._proxies:
+            return None
+
+        # never unassign hosts because of a misconfigured pool
+        proxies = self.get_proxies()
+        if not proxies:
+            return None
+
+        proxyid = select_proxy(
+            instance,
+            list(proxies.values()),
+            current=current,
+            affinity=self._proxy_affinity,
+            tolerance=self._proxy_tolerance)
+
+        if proxyid is None:
+            self.logger.warning('No eligible Zabbix Proxy for %s', instance['InstanceId'])
+            proxyid = '0'
+
+        # track host counts locally so subsequent assignments stay balanced
+        current = str(current or '0')
+        if proxyid != current:
+            if current in proxies:
+                proxies[current]['hosts'] -= 1
+            if proxyid in proxies:
+                proxies[proxyid]['hosts'] += 1
+
+        return proxyid
+
     def append_groups(self, host, groups, create_missing=True):
         """
         Append the given groups (by name) to a Zabbix Host. If create_missing is
@@ -170,6 +271,9 @@ class Configurator(object):
         given AWS EC2 Instance.
         """
 
+        if self._journal is not None:
+            return self.queue_host(instance, groups=groups, templates=templates)
+
         # lookup existing Host - it would make more sense to simply create the
         # new host and respond to an 'already exists' error by subsequently
         # updating the Host if required. Unfortunately there is no way to
@@ -181,7 +285,8 @@ class Configurator(object):
         hostid = current['hostid']
 
         # determine desired state
-        desired = instance_to_host(instance)
+        proxyid = self.assign_proxy(instance, current.get('proxy_hostid'))
+        desired = instance_to_host(instance, proxy_hostid=proxyid)
         self.append_groups(desired, groups)
         self.append_templates(desired, templates)
 
@@ -210,12 +315,143 @@ class Configurator(object):
             'message': 'Updated Zabbix Host {} ({})'.format(instance['InstanceId'], hostid),
         }
 
+    def queue_host(self, instance, groups=None, templates=None):
+        """
+        Record the desired Zabbix Host state of the given AWS EC2 Instance in the
+        write-behind journal, to be sent to Zabbix by flush.
+        """
+
+        if self._journal is None:
+            raise Exception('No write-behind journal configured')
+
+        host = instance_to_host(instance)
+        self.append_groups(host, groups)
+        self.append_templates(host, templates)
+        self._journal.record(instance, host)
+
+        return {
+            'hostid': self._cache['hostids'].get(instance['InstanceId']),
+            'message': 'Queued changes for Zabbix Host {}'.format(instance['InstanceId']),
+        }
+
+    def flush(self, force=False):
+        """
+        Send all changes in the write-behind journal that are older than the
+        journal window (or all changes if force is true) to Zabbix, using a
+        single host.update and host.create request. If a bulk request fails,
+        each host is sent separately and only the failed changes are retained.
+        """
+
+        if self._journal is None:
+            return {'message': 'No write-behind journal configured'}
+
+        start = self._journal.clock()
+        entries = self._journal.due(force)
+        if not entries:
+            return {
+                'message': 'No Zabbix Host changes due',
+                'metrics': self._journal.metrics(),
+            }
+
+        # lookup all existing hosts at once
+        response = self._api.do_request('host.get', {
+            'filter': {'host': [entry['instanceid'] for entry in entries]},
+            'output': 'extend',
+            'selectGroups': 'extend',
+            'selectInterfaces': 'extend',
+            'selectInventory': 'extend',
+            'selectMacros': 'extend',
+        })
+
+        current = {}
+        for host in response['result']:
+            current[host['host']] = host
+            self._cache['hostids'][host['host']] = host['hostid']
+
+            # invalidate cache
+            if host['hostid'] in self._cache['hosts']:
+                del self._cache['hosts'][host['hostid']]
+
+        updates = []
+        creates = []
+        unchanged = []
+        for entry in entries:
+            host = entry['host']
+            existing = current.get(entry['instanceid'])
+            if existing is None:
+                proxyid = self.assign_proxy(entry['instance'])
+            else:
+                proxyid = self.assign_proxy(entry['instance'], existing.get('proxy_hostid'))
+            if proxyid is not None:
+                host['proxy_hostid'] = proxyid
+
+            if existing is None:
+                creates.append((entry, host))
+            else:
+                diff = host_diff(existing, host)
+                if diff:
+                    updates.append((entry, diff))
+                else:
+                    unchanged.append(entry)
+
+        updated, update_failed = self._bulk_request('host.update', updates)
+        created, create_failed = self._bulk_request('host.create', creates)
+        for entry, hostid in created:
+            self._cache['hostids'][entry['instanceid']] = hostid
+
+        # changes are only removed once they are safely in Zabbix
+        flushed = unchanged + [entry for entry, _ in updated + created]
+        self._journal.fail(update_failed + create_failed)
+        self._journal.remove(flushed, start)
+
+        metrics = self._journal.metrics()
+        changes = sum(entry['changes'] for entry in flushed)
+        self.logger.info(
+            'Flushed %d changes to %d hosts (%d failed, queue depth: %d)',
+            changes, len(flushed), metrics['failed'], metrics['queue_depth'])
+
+        return {
+            'message': 'Flushed {} changes to Zabbix Hosts ({} updated, {} created, {} failed)'.format(
+                changes, len(updated), len(created), metrics['failed']),
+            'metrics': metrics,
+        }
+
+    def _bulk_request(self, method, items):
+        """
+        Sends the params of the given (entry, params) items to Zabbix in a
+        single request. If the request fails, each item is sent separately so
+        that one bad item cannot block the others. Returns a list of
+        (entry, hostid) for each success, and a list of failed entries.
+        """
+
+        if not items:
+            return [], []
+
+        try:
+            response = self._api.do_request(method, [params for _, params in items])
+            return list(zip([entry for entry, _ in items], response['result']['hostids'])), []
+        except Exception as err:
+            self.logger.warning('Bulk %s failed, retrying each host: %s', method, err)
+
+        succeeded = []
+        failed = []
+        for entry, params in items:
+            try:
+                response = self._api.do_request(method, params)
+                succeeded.append((entry, response['result']['hostids'][0]))
+            except Exception as err:
+                self.logger.error('%s failed for %s: %s', method, entry['instanceid'], err)
+                failed.append(entry)
+
+        return succeeded, failed
+
     def create_host(self, instance, groups=None, templates=None):
         """
         Create a new Zabbix Host for the given AWS EC2 Instance.
         """
 
-        host = instance_to_host(instance)
+        proxyid = self.assign_proxy(instance)
+        host = instance_to_host(instance, proxy_hostid=proxyid)
         self.append_groups(host, groups)
         self.append_templates(host, templates)
 
@@ -229,18 +465,37 @@ class Configurator(object):
                 hostid)
         }
 
-    def toggle_host(self, instance, enable=True):
+    def toggle_host(self, instance, enable=True, ignore_missing=False):
         """
         Enable or disable the given AWS EC2 Instance for monitoring in Zabbix.
         """
 
+        status = 0 if enable else 1
+        statuses = ['Enabled', 'Disabled']
+
+        # merge into any pending change, as the host may not be created yet
+        if self._journal is not None:
+            entry = self._journal.pending(instance)
+            if entry is not None:
+                entry['host']['status'] = status
+                self._journal.record(entry['instance'], entry['host'])
+                return {
+                    'hostid': self._cache['hostids'].get(instance['InstanceId']),
+                    'message': 'Queued status change ({}) for Zabbix Host {}'.format(
+                        statuses[status],
+                        instance['InstanceId'])
+                }
+
         # invalidate cache
-        hostid = self.get_hostid(instance)
+        hostid = self.get_hostid(instance, raise_missing=not ignore_missing)
+        if hostid is None and ignore_missing:
+            return {
+                'hostid': None,
+                'message': 'Zabbix Host {} does not exist'.format(instance['InstanceId'])
+            }
         if hostid in self._cache['hosts']:
             del self._cache['hosts'][hostid]
 
-        status = 0 if enable else 1
-        statuses = ['Enabled', 'Disabled']
         self._api.do_request('host.update', {
             'hostid': hostid,
             'status': str(status)
@@ -262,6 +517,10 @@ class Configurator(object):
 
         from datetime import datetime
 
+        # pending changes must not recreate or re-enable an archived host
+        if self._journal is not None:
+            self._journal.discard(instance)
+
         # invalidate cache
         hostid = self.get_hostid(instance, raise_missing=not ignore_missing)
         if hostid is None and ignore_missing:
@@ -273,6 +532,19 @@ class Configurator(object):
         if hostid in self._cache['hosts']:
             del self._cache['hosts'][hostid]
 
+        # archive macros can only be created once, so skip archived hosts
+        response = self._api.do_request('usermacro.get', {
+            'hostids': [hostid],
+            'filter': {'macro': '{$ARCHIVE_DATE}'}
+        })
+        if response['result']:
+            return {
+                'hostid': hostid,
+                'message': 'Zabbix Host {} ({}) is already archived'.format(
+                    instance['InstanceId'],
+                    hostid)
+            }
+
         # disable and move to archive group
         groupid = self.get_group_id(group, create_missing=True)
         self._api.do_request('host.update', {
@@ -313,6 +585,8 @@ class Configurator(object):
         hostid = self.get_hostid(instance)
         if hostid in self._cache['hosts']:
             del self._cache['hosts'][hostid]
+        if self._journal is not None:
+            self._journal.discard(instance)
 
         self._api.do_request('host.delete', [hostid])
         return {
@@ -2,6 +2,21 @@
 Handlers contains useful Lambda handlers for Amazon AWS events.
 """
 
+def _default_configurator(journal=False):
+    """
+    Returns a Configurator connected using environment variables. A
+    write-behind Journal is used if journal is true or ZABBOPS_JOURNAL_PATH is
+    set.
+    """
+
+    from os import environ
+    from .configurator import Configurator
+    from .journal import Journal
+
+    if journal or 'ZABBOPS_JOURNAL_PATH' in environ:
+        return Configurator(journal=Journal())
+    return Configurator()
+
 def KinesisStreamHandler(lambda_handler):
     """
     KinesisStreamHandler wraps any Lambda Function handler that expects a
@@ -28,3 +43,145 @@ def KinesisStreamHandler(lambda_handler):
         }
 
     return handler
+
+def EC2StateChangeHandler(configurator=None, ec2=None, groups=None, templates=None,
+                          ttl=60, reason='EC2 Instance terminated'):
+    """
+    EC2StateChangeHandler returns a Lambda Function handler that accepts a batch
+    of EC2 Instance State-change Notification CloudWatch Events from a Kinesis
+    Stream. All Instances in the batch are described in a single paged request
+    and each event is routed to Configurator.upsert_host, toggle_host or
+    archive_host. Described Instances are cached for ttl seconds. Any
+    journaled changes that are due are flushed at the end of each batch.
+    """
+
+    from logging import getLogger
+
+    logger = getLogger('zabbops')
+    cache = {}
+    clients = {'configurator': configurator, 'ec2': ec2}
+
+    def describe_instances(instanceids):
+        """
+        Returns the given EC2 Instances keyed by Instance ID. Instances which
+        can no longer be described are omitted.
+        """
+
+        from time import time
+
+        # drop expired instances so the cache stays small in warm containers
+        now = time()
+        for instanceid in [k for k, v in cache.items() if v[0] <= now]:
+            del cache[instanceid]
+
+        instances = {}
+        missing = []
+        for instanceid in instanceids:
+            if instanceid in cache and cache[instanceid][0] > now:
+                instances[instanceid] = cache[instanceid][1]
+            elif instanceid not in missing:
+                missing.append(instanceid)
+
+        if missing:
+            if clients['ec2'] is None:
+                from boto3 import client
+                clients['ec2'] = client('ec2')
+
+            # a filter is used, rather than InstanceIds, so that unknown
+            # Instances are omitted instead of failing the entire request
+            paginator = clients['ec2'].get_paginator('describe_instances')
+            for i in range(0, len(missing), 200):
+                pages = paginator.paginate(Filters=[{
+                    'Name': 'instance-id',
+                    'Values': missing[i:i+200]
+                }])
+                for page in pages:
+                    for reservation in page['Reservations']:
+                        for instance in reservation['Instances']:
+                            instances[instance['InstanceId']] = instance
+                            cache[instance['InstanceId']] = (now + ttl, instance)
+
+            logger.debug('Described %d of %d instances', len(instances), len(instanceids))
+
+        return instances
+
+    def handler(event, context):
+        """
+        Handler function to process a Kinesis Stream batch of EC2 Instance
+        state-change events.
+        """
+
+        from base64 import b64decode
+        from json import loads
+
+        if clients['configurator'] is None:
+            clients['configurator'] = _default_configurator()
+        config = clients['configurator']
+
+        changes = []
+        for record in event['Records']:
+            revent = loads(b64decode(record['kinesis']['data']))
+            changes.append((revent['detail']['instance-id'], revent['detail']['state']))
+
+        instances = describe_instances([instanceid for instanceid, _ in changes])
+
+        results = []
+        for instanceid, state in changes:
+            if instanceid in instances:
+                # the event state is more recent than a cached description
+                instance = dict(instances[instanceid])
+                instance['State'] = dict(instance['State'], Name=state)
+            elif state in ('shutting-down', 'terminated'):
+                # terminated instances may no longer be described
+                instance = {'InstanceId': instanceid}
+            else:
+                logger.warning('EC2 Instance not found: %s', instanceid)
+                continue
+
+            if state == 'terminated':
+                results.append(config.archive_host(
+                    instance, reason=reason, ignore_missing=True))
+            elif state in ('shutting-down', 'stopping', 'stopped'):
+                results.append(config.toggle_host(
+                    instance, enable=False, ignore_missing=True))
+            else:
+                results.append(config.upsert_host(
+                    instance, groups=groups, templates=templates))
+
+        # send any journaled changes that are due. Failed changes stay in the
+        # journal, so the batch must not fail (and be replayed) because of them
+        try:
+            flushed = config.flush()
+        except Exception as err:
+            logger.exception('Failed to flush journal: %s', err)
+            flushed = {'message': 'Failed to flush journal: {}'.format(err)}
+
+        return {
+            'message': 'Processed {} records'.format(len(event['Records'])),
+            'results': results,
+            'flush': flushed,
+        }
+
+    return handler
+
+def FlushHandler(configurator=None):
+    """
+    FlushHandler returns a Lambda Function handler that sends all changes in
+    the write-behind journal to Zabbix, regardless of the journal window. It
+    should be scheduled (e.g. by a CloudWatch Events rule) so that changes are
+    not left in the journal when no further events are received.
+    """
+
+    clients = {'configurator': configurator}
+
+    def handler(event, context):
+        """
+        Handler function to flush the write-behind journal.
+        """
+
+        if clients['configurator'] is None:
+            clients['configurator'] = _default_configurator(journal=True)
+
+        return clients['configurator'].flush(force=True)
+
+    return handler
@@ -0,0 +1,222 @@
+"""
+Journal provides a durable, local write-behind queue of desired Zabbix Host
+states, so that successive changes to an EC2 Instance can be merged and sent to
+Zabbix in bulk.
+"""
+
+def _row_to_entry(row):
+    """Converts a journal database row to a pending change"""
+
+    from json import loads
+
+    return {
+        'instanceid': row[0],
+        'host': loads(row[1]),
+        'instance': loads(row[2]),
+        'first_seen': row[3],
+        'last_seen': row[4],
+        'changes': row[5],
+        'failures': row[6],
+    }
+
+class Journal(object):
+    """
+    Journal records the desired Zabbix Host state of each EC2 Instance in a
+    SQLite database. Changes recorded for the same Instance within the window
+    (in seconds) are merged, with the most recent state winning. Changes are
+    only removed from the journal once they have been flushed, so a crash will
+    not lose them. Changes that fail to flush max_failures times in a row are
+    moved to a quarantine table, so that they do not block other changes.
+
+    The path and window default to the ZABBOPS_JOURNAL_PATH and
+    ZABBOPS_JOURNAL_WINDOW environment variables. The default path is in /tmp,
+    which does not outlive a Lambda container. To guarantee delivery, the path
+    should be on persistent storage (e.g. an EFS mount) that is shared with a
+    scheduled FlushHandler.
+    """
+
+    def __init__(self, path=None, window=None, clock=None, max_failures=5):
+        from logging import getLogger
+        from os import environ
+        from sqlite3 import connect
+        from time import time
+
+        if path is None:
+            path = environ.get('ZABBOPS_JOURNAL_PATH', '/tmp/zabbops.db')
+        if window is None:
+            window = float(environ.get('ZABBOPS_JOURNAL_WINDOW', 60))
+
+        self.window = window
+        self.max_failures = max_failures
+        self.clock = clock or time
+        self.logger = getLogger('zabbops')
+        self._metrics = {
+            'flush_latency': None,
+            'flush_age': None,
+            'merge_ratio': None,
+            'failed': None,
+        }
+
+        self._db = connect(path)
+        with self._db:
+            for table in ('changes', 'quarantine'):
+                self._db.execute(
+                    'CREATE TABLE IF NOT EXISTS ' + table + ' ('
+                    ' instanceid TEXT PRIMARY KEY,'
+                    ' host TEXT NOT NULL,'
+                    ' instance TEXT NOT NULL,'
+                    ' first_seen REAL NOT NULL,'
+                    ' last_seen REAL NOT NULL,'
+                    ' changes INTEGER NOT NULL,'
+                    ' failures INTEGER NOT NULL)')
+
+    def record(self, instance, host):
+        """
+        Record the desired Zabbix Host state of the given EC2 Instance, merging
+        it with any change already pending for the Instance.
+        """
+
+        from json import dumps
+
+        # only the placement of the instance is retained for proxy assignment
+        instanceid = instance['InstanceId']
+        placement = dumps({
+            'InstanceId': instanceid,
+            'Placement': instance.get('Placement', {}),
+            'VpcId': instance.get('VpcId'),
+        })
+
+        now = self.clock()
+        with self._db:
+            cursor = self._db.execute(
+                'UPDATE changes SET host = ?, instance = ?, last_seen = ?,'
+                ' changes = changes + 1, failures = 0 WHERE instanceid = ?',
+                (dumps(host), placement, now, instanceid))
+            if not cursor.rowcount:
+                self._db.execute(
+                    'INSERT INTO changes VALUES (?, ?, ?, ?, ?, 1, 0)',
+                    (instanceid, dumps(host), placement, now, now))
+
+        self.logger.debug('Journaled change for %s', instanceid)
+
+    def pending(self, instance):
+        """
+        Returns the pending change for the given EC2 Instance, or None.
+        """
+
+        cursor = self._db.execute(
+            'SELECT * FROM changes WHERE instanceid = ?',
+            (instance['InstanceId'],))
+
+        row = cursor.fetchone()
+        return _row_to_entry(row) if row else None
+
+    def discard(self, instance):
+        """
+        Discard any pending change for the given EC2 Instance.
+        """
+
+        with self._db:
+            self._db.execute('DELETE FROM changes WHERE instanceid = ?',
+                             (instance['InstanceId'],))
+
+    def due(self, force=False):
+        """
+        Returns all pending changes that were first recorded longer than the
+        window ago, or all pending changes if force is true.
+        """
+
+        cutoff = float('inf') if force else self.clock() - self.window
+        cursor = self._db.execute(
+            'SELECT * FROM changes WHERE first_seen <= ? ORDER BY first_seen',
+            (cutoff,))
+
+        return [_row_to_entry(row) for row in cursor]
+
+    def remove(self, entries, start=None):
+        """
+        Remove the given flushed changes from the journal and update the flush
+        metrics. Changes recorded since the entries were read are retained as
+        new changes. start is the time the flush began.
+        """
+
+        now = self.clock()
+        start = now if start is None else start
+        self._metrics['flush_latency'] = now - start
+        if not entries:
+            return
+
+        with self._db:
+            self._db.executemany(
+                'UPDATE changes SET changes = MAX(changes - ?, 1), first_seen = ?'
+                ' WHERE instanceid = ? AND last_seen > ?',
+                [(entry['changes'], entry['last_seen'], entry['instanceid'],
+                  entry['last_seen']) for entry in entries])
+            self._db.executemany(
+                'DELETE FROM changes WHERE instanceid = ? AND last_seen <= ?',
+                [(entry['instanceid'], entry['last_seen']) for entry in entries])
+
+        changes = sum(entry['changes'] for entry in entries)
+        self._metrics['flush_age'] = start - min(entry['first_seen'] for entry in entries)
+        self._metrics['merge_ratio'] = 1 - float(len(entries)) / changes
+
+    def fail(self, entries):
+        """
+        Record that the given changes failed to flush. Changes that have failed
+        max_failures times are moved to quarantine.
+        """
+
+        self._metrics['failed'] = len(entries)
+        if not entries:
+            return
+
+        instanceids = [(entry['instanceid'],) for entry in entries]
+        with self._db:
+            self._db.executemany(
+                'UPDATE changes SET failures = failures + 1 WHERE instanceid = ?',
+                instanceids)
+            self._db.execute(
+                'INSERT OR REPLACE INTO quarantine'
+                ' SELECT * FROM changes WHERE failures >= ?',
+                (self.max_failures,))
+            self._db.execute(
+                'DELETE FROM changes WHERE failures >= ?',
+                (self.max_failures,))
+
+        for entry in entries:
+            if entry['failures'] + 1 >= self.max_failures:
+                self.logger.error('Quarantined change for %s', entry['instanceid'])
+
+    def quarantined(self):
+        """
+        Returns all quarantined changes.
+        """
+
+        cursor = self._db.execute('SELECT * FROM quarantine ORDER BY first_seen')
+        return [_row_to_entry(row) for row in cursor]
+
+    def depth(self):
+        """
+        Returns the number of Instances with pending changes.
+        """
+
+        return self._db.execute('SELECT COUNT(*) FROM changes').fetchone()[0]
+
+    def metrics(self):
+        """
+        Returns the metrics of the last flush, the current queue depth and the
+        number of quarantined changes.
+        """
+
+        metrics = dict(self._metrics)
+        metrics['queue_depth'] = self.depth()
+        metrics['quarantined'] = self._db.execute(
+            'SELECT COUNT(*) FROM quarantine').fetchone()[0]
+        return metrics
+
+    def close(self):
+        """
+        Close the journal database.
+        """
+
+        self._db.close()
@@ -2,4 +2,8 @@
 Test cases for zabbops module
 """
 
-from .configurator import ConfiguratorTests
+from .configurator import ConfiguratorTests, StubbedConfiguratorTests
+from .transform import TransformTests
+from .handlers import HandlerTests
+from .journal import JournalTests, WriteBehindTests
+from .proxies import ProxyTests
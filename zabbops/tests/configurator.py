@@ -33,6 +33,28 @@ INSTANCE = {
     ],
 }
 
+class StubZabbixAPI(object):
+    """
+    StubZabbixAPI mimics the do_request method of a py-zabbix ZabbixAPI. Each
+    result is either a canned value or a function of the request params.
+    """
+
+    def __init__(self, results=None):
+        self.results = results or {}
+        self.calls = []
+
+    def do_request(self, method, params):
+        self.calls.append((method, params))
+        result = self.results.get(method, {})
+        if callable(result):
+            result = result(params)
+        return {'result': result}
+
+    def methods(self):
+        """Returns the name of each API method called"""
+
+        return [method for method, _ in self.calls]
+
 GROUPS = ['Linux servers', 'Virtual machines']
 ADD_GROUP = 'Hypervisors'
 TEMPLATES = ['Template OS Linux', 'Template ICMP Ping']
@@ -197,3 +219,40 @@ class ConfiguratorTests(unittest.TestCase):
         self.assertIn('hostid', ret)
         self.assertIn('message', ret)
         self.assertRegexpMatches(ret['message'], r'^Deleted Zabbix Host i-.*$')
+
+
+class StubbedConfiguratorTests(unittest.TestCase):
+    """
+    Tests for the Configurator using a stubbed Zabbix API.
+    """
+
+    def test_001_archive_twice(self):
+        """
+        Archive a Zabbix Host only once.
+        """
+
+        macros = []
+        api = StubZabbixAPI({
+            'host.get': [{'hostid': '10001'}],
+            'hostgroup.get': [{'groupid': '5'}],
+            'usermacro.get': lambda params: list(macros),
+            'usermacro.create': lambda params: macros.append(params) or {},
+        })
+        config = Configurator(api=api)
+
+        ret = config.archive_host(INSTANCE, reason='Testing')
+        self.assertRegexpMatches(ret['message'], r'^Archived Zabbix Host i-.*$')
+        ret = config.archive_host(INSTANCE, reason='Testing')
+        self.assertRegexpMatches(ret['message'], r'^Zabbix Host i-.* is already archived$')
+        self.assertEqual(len(macros), 2)
+        self.assertEqual(api.methods().count('host.update'), 1)
+
+    def test_002_toggle_missing(self):
+        """
+        Ignore a missing Zabbix Host when toggling.
+        """
+
+        api = StubZabbixAPI({'host.get': []})
+        ret = Configurator(api=api).toggle_host(INSTANCE, enable=False, ignore_missing=True)
+        self.assertIsNone(ret['hostid'])
+        self.assertEqual(api.methods(), ['host.get'])
@@ -0,0 +1,190 @@
+"""
+Tests for zabbops Lambda handlers
+"""
+
+import logging
+import unittest
+from base64 import b64encode
+from copy import deepcopy
+from json import dumps
+from ..handlers import EC2StateChangeHandler, FlushHandler
+from ..transform import instance_to_host
+from .configurator import INSTANCE
+
+class StubEC2(object):
+    """
+    StubEC2 mimics the describe_instances paginator of a boto3 EC2 client.
+    """
+
+    def __init__(self, instances):
+        self.instances = instances
+        self.calls = []
+
+    def get_paginator(self, operation):
+        assert operation == 'describe_instances'
+        return self
+
+    def paginate(self, Filters):
+        self.calls.append(Filters[0]['Values'])
+        instances = [i for i in self.instances if i['InstanceId'] in Filters[0]['Values']]
+        return [{'Reservations': [{'Instances': [i]}]} for i in instances]
+
+class StubConfigurator(object):
+    """
+    StubConfigurator records each call made by a handler.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.flushes = []
+
+    def upsert_host(self, instance, groups=None, templates=None):
+        self.calls.append(('upsert_host', instance))
+        return {}
+
+    def toggle_host(self, instance, enable=True, ignore_missing=False):
+        self.calls.append(('toggle_host', instance))
+        return {}
+
+    def archive_host(self, instance, group='Archive', reason=None, ignore_missing=False):
+        self.calls.append(('archive_host', instance))
+        return {}
+
+    def flush(self, force=False):
+        self.flushes.append(force)
+        return {}
+
+def kinesis_event(*changes):
+    """Returns a Kinesis Stream batch of EC2 state-change events"""
+
+    records = []
+    for instanceid, state in changes:
+        data = dumps({
+            'detail-type': 'EC2 Instance State-change Notification',
+            'detail': {'instance-id': instanceid, 'state': state}
+        })
+        records.append({'kinesis': {'data': b64encode(data.encode('utf-8'))}})
+
+    return {'Records': records}
+
+class HandlerTests(unittest.TestCase):
+    """
+    Tests for the Lambda handlers. These tests do not require access to Zabbix
+    or AWS.
+    """
+
+    def test_001_state_change_batch(self):
+        """
+        Describe all Instances of a batch at once and route each event.
+        """
+
+        running = deepcopy(INSTANCE)
+        running['InstanceId'] = 'i-cafebabe'
+        running['State'] = {'Code': 16, 'Name': 'running'}
+        ec2 = StubEC2([INSTANCE, running])
+        config = StubConfigurator()
+        handler = EC2StateChangeHandler(configurator=config, ec2=ec2)
+
+        ret = handler(kinesis_event(
+            ('i-cafebabe', 'running'),
+            ('i-deadbeef', 'stopped'),
+            ('i-cafebabe', 'running'),
+            ('i-00000000', 'terminated'),
+        ), None)
+
+        self.assertEqual(ret['message'], 'Processed 4 records')
+        self.assertEqual(ec2.calls, [['i-cafebabe', 'i-deadbeef', 'i-00000000']])
+        stopped = deepcopy(INSTANCE)
+        self.assertEqual(config.calls, [
+            ('upsert_host', running),
+            ('toggle_host', stopped),
+            ('upsert_host', running),
+            ('archive_host', {'InstanceId': 'i-00000000'}),
+        ])
+        self.assertEqual(config.flushes, [False])
+
+    def test_002_state_change_cache(self):
+        """
+        Reuse cached Instances in subsequent batches.
+        """
+
+        ec2 = StubEC2([INSTANCE])
+        config = StubConfigurator()
+        handler = EC2StateChangeHandler(configurator=config, ec2=ec2)
+        handler(kinesis_event(('i-deadbeef', 'stopping')), None)
+        handler(kinesis_event(('i-deadbeef', 'running')), None)
+        self.assertEqual(len(ec2.calls), 1)
+
+        # the event state must override the cached state
+        self.assertEqual([instance['State']['Name'] for _, instance in config.calls],
+                         ['stopping', 'running'])
+        self.assertEqual(INSTANCE['State']['Name'], 'stopped')
+
+        handler = EC2StateChangeHandler(configurator=config, ec2=ec2, ttl=0)
+        handler(kinesis_event(('i-deadbeef', 'running')), None)
+        handler(kinesis_event(('i-deadbeef', 'stopping')), None)
+        self.assertEqual(len(ec2.calls), 3)
+
+    def test_003_state_change_termination(self):
+        """
+        Disable a shutting-down Instance and archive it once terminated.
+        """
+
+        config = StubConfigurator()
+        handler = EC2StateChangeHandler(configurator=config, ec2=StubEC2([]))
+        handler(kinesis_event(
+            ('i-deadbeef', 'shutting-down'),
+            ('i-deadbeef', 'terminated'),
+        ), None)
+
+        self.assertEqual(config.calls, [
+            ('toggle_host', {'InstanceId': 'i-deadbeef'}),
+            ('archive_host', {'InstanceId': 'i-deadbeef'}),
+        ])
+
+    def test_004_flush(self):
+        """
+        Flush all journaled changes on schedule.
+        """
+
+        config = StubConfigurator()
+        FlushHandler(configurator=config)({}, None)
+        self.assertEqual(config.flushes, [True])
+
+    def test_005_state_change_untagged(self):
+        """
+        Upsert Instances without Tags.
+        """
+
+        untagged = deepcopy(INSTANCE)
+        untagged['State'] = {'Code': 16, 'Name': 'running'}
+        del untagged['Tags']
+
+        config = StubConfigurator()
+        handler = EC2StateChangeHandler(configurator=config, ec2=StubEC2([untagged]), ttl=0)
+        handler(kinesis_event(('i-deadbeef', 'running')), None)
+        self.assertEqual(config.calls, [('upsert_host', untagged)])
+
+        host = instance_to_host(untagged)
+        self.assertEqual(host['name'], 'i-deadbeef')
+        self.assertEqual(host['macros'], [])
+
+
+    def test_006_flush_failure(self):
+        """
+        Complete the batch if the journal cannot be flushed.
+        """
+
+        config = StubConfigurator()
+
+        def flush(force=False):
+            raise Exception('Zabbix unavailable')
+
+        config.flush = flush
+        handler = EC2StateChangeHandler(configurator=config, ec2=StubEC2([INSTANCE]))
+        with self.assertLogs('zabbops', logging.ERROR):
+            ret = handler(kinesis_event(('i-deadbeef', 'stopped')), None)
+
+        self.assertEqual(ret['message'], 'Processed 1 records')
+        self.assertEqual(ret['flush']['message'], 'Failed to flush journal: Zabbix unavailable')
+        self.assertEqual(len(config.calls), 1)
@@ -0,0 +1,272 @@
+"""
+Tests for the zabbops write-behind journal
+"""
+
+import os
+import tempfile
+import unittest
+from copy import deepcopy
+from ..configurator import Configurator
+from ..journal import Journal
+from ..transform import instance_to_host
+from .configurator import INSTANCE, StubZabbixAPI
+
+class StubClock(object):
+    """
+    StubClock is a manually advanced replacement for time.time.
+    """
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+def existing_host(instance, hostid='10001', **fields):
+    """Returns the Zabbix Host state of an already configured Instance"""
+
+    host = instance_to_host(instance)
+    host['hostid'] = hostid
+    host.update(fields)
+    return host
+
+class JournalTests(unittest.TestCase):
+    """
+    Tests for the write-behind Journal. These tests do not require access to
+    Zabbix or AWS.
+    """
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.clock = StubClock()
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_001_merge_changes(self):
+        """
+        Merge successive changes to the same Instance.
+        """
+
+        journal = Journal(self.path, window=0, clock=self.clock)
+        host = instance_to_host(INSTANCE)
+        journal.record(INSTANCE, host)
+        host['description'] = 'Updated description'
+        journal.record(INSTANCE, host)
+
+        entries = journal.due()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['changes'], 2)
+        self.assertEqual(entries[0]['host']['description'], 'Updated description')
+        self.assertEqual(entries[0]['instance']['VpcId'], INSTANCE['VpcId'])
+        self.assertEqual(journal.pending(INSTANCE), entries[0])
+        journal.close()
+
+    def test_002_window(self):
+        """
+        Withhold changes until the window has elapsed.
+        """
+
+        journal = Journal(self.path, window=60, clock=self.clock)
+        journal.record(INSTANCE, instance_to_host(INSTANCE))
+        self.assertEqual(journal.due(), [])
+        self.assertEqual(len(journal.due(force=True)), 1)
+
+        self.clock.now += 60
+        self.assertEqual(len(journal.due()), 1)
+        journal.close()
+
+    def test_003_durability(self):
+        """
+        Retain changes across restarts until they are removed.
+        """
+
+        journal = Journal(self.path, window=0, clock=self.clock)
+        journal.record(INSTANCE, instance_to_host(INSTANCE))
+        journal.record(INSTANCE, instance_to_host(INSTANCE))
+        journal.close()
+
+        journal = Journal(self.path, window=0, clock=self.clock)
+        entries = journal.due()
+        self.assertEqual(journal.depth(), 1)
+
+        # changes recorded during a flush are retained as new changes
+        self.clock.now += 1
+        journal.record(INSTANCE, instance_to_host(INSTANCE))
+        self.clock.now += 1
+        journal.remove(entries, start=self.clock.now - 2)
+        self.assertEqual(journal.depth(), 1)
+        self.assertEqual(journal.pending(INSTANCE)['changes'], 1)
+        self.assertEqual(journal.pending(INSTANCE)['first_seen'], entries[0]['last_seen'])
+
+        metrics = journal.metrics()
+        self.assertEqual(metrics['flush_latency'], 2)
+        self.assertEqual(metrics['merge_ratio'], 0.5)
+        self.assertEqual(metrics['queue_depth'], 1)
+
+        journal.remove(journal.due())
+        self.assertEqual(journal.depth(), 0)
+
+        journal.record(INSTANCE, instance_to_host(INSTANCE))
+        journal.discard(INSTANCE)
+        self.assertEqual(journal.depth(), 0)
+        journal.close()
+
+    def test_004_environment(self):
+        """
+        Configure the journal using environment variables.
+        """
+
+        os.environ['ZABBOPS_JOURNAL_PATH'] = self.path
+        os.environ['ZABBOPS_JOURNAL_WINDOW'] = '5'
+        try:
+            journal = Journal()
+        finally:
+            del os.environ['ZABBOPS_JOURNAL_PATH']
+            del os.environ['ZABBOPS_JOURNAL_WINDOW']
+
+        self.assertEqual(journal.window, 5)
+        journal.record(INSTANCE, instance_to_host(INSTANCE))
+        journal.close()
+        self.assertEqual(Journal(self.path).depth(), 1)
+
+class WriteBehindTests(unittest.TestCase):
+    """
+    Tests for the write-behind mode of the Configurator using a stubbed Zabbix
+    API.
+    """
+
+    def setUp(self):
+        self.clock = StubClock()
+        self.journal = Journal(':memory:', window=60, clock=self.clock)
+
+        self.created = deepcopy(INSTANCE)
+        self.created['InstanceId'] = 'i-cafebabe'
+
+    def tearDown(self):
+        self.journal.close()
+
+    def test_001_queue_host(self):
+        """
+        Queue changes without calling Zabbix until the window has elapsed.
+        """
+
+        api = StubZabbixAPI()
+        config = Configurator(api=api, journal=self.journal)
+        ret = config.upsert_host(INSTANCE)
+        self.assertRegexpMatches(ret['message'], r'^Queued changes for Zabbix Host i-.*$')
+        config.upsert_host(INSTANCE)
+
+        ret = config.flush()
+        self.assertEqual(ret['message'], 'No Zabbix Host changes due')
+        self.assertEqual(ret['metrics']['queue_depth'], 1)
+        self.assertEqual(api.calls, [])
+
+    def test_002_flush(self):
+        """
+        Flush due changes with a single array host.update and host.create.
+        """
+
+        api = StubZabbixAPI({
+            'host.get': [existing_host(INSTANCE, description='Outdated')],
+            'host.update': {'hostids': ['10001']},
+            'host.create': {'hostids': ['10002']},
+        })
+        config = Configurator(api=api, journal=self.journal)
+        config.upsert_host(INSTANCE)
+        config.upsert_host(INSTANCE)
+        config.upsert_host(self.created)
+        self.clock.now += 60
+
+        ret = config.flush()
+        self.assertEqual(api.methods(), ['host.get', 'host.update', 'host.create'])
+        self.assertEqual(sorted(api.calls[0][1]['filter']['host']),
+                         ['i-cafebabe', 'i-deadbeef'])
+
+        updates = api.calls[1][1]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(updates[0]['hostid'], '10001')
+        self.assertEqual(updates[0]['description'], 'Zabbops EC2 Test Instance')
+
+        creates = api.calls[2][1]
+        self.assertEqual([host['host'] for host in creates], ['i-cafebabe'])
+        self.assertEqual(config.get_hostid(self.created), '10002')
+
+        self.assertEqual(ret['metrics']['queue_depth'], 0)
+        self.assertEqual(ret['metrics']['flush_age'], 60)
+        self.assertEqual(ret['metrics']['merge_ratio'], 1 - 2.0 / 3)
+        self.assertEqual(ret['metrics']['failed'], 0)
+
+    def test_003_flush_failure(self):
+        """
+        Retain rejected changes without blocking others, and quarantine changes
+        that are rejected repeatedly.
+        """
+
+        def reject(params):
+            if isinstance(params, list) or params['host'] == 'i-deadbeef':
+                raise Exception('Zabbix rejected host')
+            return {'hostids': ['10002']}
+
+        api = StubZabbixAPI({'host.get': [], 'host.create': reject})
+        self.journal.max_failures = 2
+        config = Configurator(api=api, journal=self.journal)
+        config.upsert_host(INSTANCE)
+        config.upsert_host(self.created)
+
+        ret = config.flush(force=True)
+        self.assertEqual(api.methods(), ['host.get', 'host.create', 'host.create', 'host.create'])
+        self.assertEqual(ret['metrics']['failed'], 1)
+        self.assertEqual(ret['metrics']['queue_depth'], 1)
+        self.assertEqual(config.get_hostid(self.created), '10002')
+        self.assertEqual(self.journal.pending(INSTANCE)['failures'], 1)
+
+        ret = config.flush(force=True)
+        self.assertEqual(ret['metrics']['queue_depth'], 0)
+        self.assertEqual(ret['metrics']['quarantined'], 1)
+        self.assertEqual(self.journal.quarantined()[0]['instanceid'], 'i-deadbeef')
+
+        # quarantined changes are no longer retried
+        ret = config.flush(force=True)
+        self.assertEqual(ret['message'], 'No Zabbix Host changes due')
+
+    def test_004_flush_proxies(self):
+        """
+        Assign Proxies to hosts at flush time.
+        """
+
+        api = StubZabbixAPI({
+            'host.get': [existing_host(INSTANCE, proxy_hostid='1')],
+            'host.create': {'hostids': ['10002']},
+            'proxy.get': [
+                {'proxyid': '1', 'host': 'proxy1', 'hosts': [{'hostid': '10001'}]},
+                {'proxyid': '2', 'host': 'proxy2', 'hosts': []},
+            ],
+        })
+        config = Configurator(api=api, proxies=['proxy1', 'proxy2'], journal=self.journal)
+        config.upsert_host(INSTANCE)
+        config.upsert_host(self.created)
+
+        config.flush(force=True)
+        self.assertNotIn('host.update', api.methods())
+        self.assertEqual(api.calls[-1][1][0]['proxy_hostid'], '2')
+
+    def test_005_toggle_pending(self):
+        """
+        Merge status changes into pending changes of hosts not yet created.
+        """
+
+        api = StubZabbixAPI({'host.get': []})
+        config = Configurator(api=api, journal=self.journal)
+        self.created['State'] = {'Code': 16, 'Name': 'running'}
+        config.upsert_host(self.created)
+
+        ret = config.toggle_host(self.created, enable=False)
+        self.assertRegexpMatches(ret['message'], r'^Queued status change \(Disabled\) .*$')
+        self.assertEqual(api.calls, [])
+
+        entry = self.journal.pending(self.created)
+        self.assertEqual(entry['host']['status'], 1)
+        self.assertEqual(entry['host']['description'], 'Zabbops EC2 Test Instance')
+        self.assertEqual(entry['changes'], 2)
@@ -0,0 +1,129 @@
+"""
+Tests for zabbops Proxy assignment
+"""
+
+import logging
+import unittest
+from ..configurator import Configurator
+from .configurator import INSTANCE, StubZabbixAPI
+
+def proxy_api(*counts):
+    """Returns a stub API with a Proxy per given number of hosts"""
+
+    return StubZabbixAPI({'proxy.get': [{
+        'proxyid': str(i + 1),
+        'host': 'proxy{}'.format(i + 1),
+        'hosts': [{'hostid': str(n)} for n in range(count)],
+    } for i, count in enumerate(counts)]})
+
+class ProxyTests(unittest.TestCase):
+    """
+    Tests for Configurator Proxy assignment using a stubbed Zabbix API.
+    """
+
+    def test_001_get_proxies(self):
+        """
+        Fetch all Proxies and their host counts in a single request.
+        """
+
+        api = proxy_api(3, 1)
+        config = Configurator(api=api, proxies=[
+            'proxy1',
+            {'host': 'proxy2', 'availability_zone': 'us-west-1b'},
+            'proxy3',
+        ])
+
+        with self.assertLogs('zabbops', logging.WARNING) as logs:
+            proxies = config.get_proxies()
+        self.assertIn('Zabbix Proxy not found: proxy3', logs.output[0])
+
+        self.assertEqual(api.methods(), ['proxy.get'])
+        self.assertEqual(sorted(api.calls[0][1]['filter']['host']),
+                         ['proxy1', 'proxy2', 'proxy3'])
+        self.assertEqual(proxies['1']['hosts'], 3)
+        self.assertEqual(proxies['2']['hosts'], 1)
+        self.assertEqual(proxies['2']['availability_zone'], 'us-west-1b')
+
+        config.get_proxies()
+        self.assertEqual(api.methods(), ['proxy.get'])
+
+    def test_002_proxy_cache(self):
+        """
+        Cache an empty pool, and refresh host counts once expired.
+        """
+
+        api = StubZabbixAPI({'proxy.get': []})
+        config = Configurator(api=api, proxies=['proxy1'])
+        with self.assertLogs('zabbops', logging.WARNING):
+            self.assertEqual(config.get_proxies(), {})
+            self.assertEqual(config.get_proxies(), {})
+        self.assertEqual(api.methods(), ['proxy.get'])
+
+        api = proxy_api(1)
+        config = Configurator(api=api, proxies=['proxy1'], proxy_ttl=0)
+        config.get_proxies()
+        config.get_proxies()
+        self.assertEqual(api.methods(), ['proxy.get', 'proxy.get'])
+
+    def test_003_assign_proxy(self):
+        """
+        Assign Proxies and track host counts locally.
+        """
+
+        api = proxy_api(2, 1)
+        config = Configurator(api=api, proxies=['proxy1', 'proxy2'])
+        self.assertEqual(config.assign_proxy(INSTANCE), '2')
+        self.assertEqual(config.assign_proxy(INSTANCE), '1')
+        self.assertEqual(config.get_proxies()['1']['hosts'], 3)
+        self.assertEqual(config.get_proxies()['2']['hosts'], 2)
+
+        # sticky assignment does not change counts
+        self.assertEqual(config.assign_proxy(INSTANCE, current='2'), '2')
+        self.assertEqual(config.get_proxies()['2']['hosts'], 2)
+
+        self.assertIsNone(Configurator(api=api).assign_proxy(INSTANCE))
+
+    def test_004_assign_no_eligible_proxy(self):
+        """
+        Unassign the Proxy of a Host if the pool exists, but affinity excludes
+        every Proxy.
+        """
+
+        config = Configurator(
+            api=StubZabbixAPI({'proxy.get': [{
+                'proxyid': '1', 'host': 'proxy1', 'hosts': [{'hostid': '1'}]}]}),
+            proxies=[{'host': 'proxy1', 'vpc_id': 'vpc-cafebabe'}],
+            proxy_affinity='vpc')
+
+        with self.assertLogs('zabbops', logging.WARNING):
+            self.assertEqual(config.assign_proxy(INSTANCE, current='1'), '0')
+        self.assertEqual(config.get_proxies()['1']['hosts'], 0)
+
+    def test_005_assign_empty_pool(self):
+        """
+        Retain the Proxy of a Host if no Proxy in the pool exists.
+        """
+
+        api = StubZabbixAPI({
+            'proxy.get': [],
+            'host.get': [{
+                'hostid': '10001',
+                'host': INSTANCE['InstanceId'],
+                'name': 'Ec2TestInstance (i-deadbeef)',
+                'description': 'Zabbops EC2 Test Instance',
+                'status': '1',
+                'proxy_hostid': '7',
+                'inventory': {},
+                'groups': [],
+            }],
+            'host.update': {'hostids': ['10001']},
+        })
+        config = Configurator(api=api, proxies=['typo-proxy'])
+
+        with self.assertLogs('zabbops', logging.WARNING):
+            self.assertIsNone(config.assign_proxy(INSTANCE, current='7'))
+
+        config.upsert_host(INSTANCE)
+        updates = [params for method, params in api.calls if method == 'host.update']
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn('proxy_hostid', updates[0])
@@ -0,0 +1,64 @@
+"""
+Tests for zabbops transform primitives
+"""
+
+import unittest
+from ..transform import instance_to_host, host_diff, select_proxy
+from .configurator import INSTANCE
+
+PROXIES = [
+    {'proxyid': '1', 'hosts': 10, 'availability_zone': 'us-west-1a'},
+    {'proxyid': '2', 'hosts': 5, 'availability_zone': 'us-west-1b'},
+    {'proxyid': '3', 'hosts': 20},
+]
+
+class TransformTests(unittest.TestCase):
+    """
+    Tests for the transform primitives. These tests do not require access to
+    Zabbix or AWS.
+    """
+
+    def test_001_select_least_loaded(self):
+        """
+        Select the least loaded Proxy for a new Host.
+        """
+
+        self.assertEqual(select_proxy(INSTANCE, PROXIES), '2')
+
+    def test_002_select_affinity(self):
+        """
+        Select only Proxies in the same Availability Zone.
+        """
+
+        self.assertEqual(select_proxy(INSTANCE, PROXIES, affinity='az'), '1')
+        self.assertIsNone(select_proxy(INSTANCE, PROXIES[1:2], affinity='az'))
+        self.assertRaises(ValueError, select_proxy, INSTANCE, PROXIES, affinity='foo')
+
+    def test_003_select_sticky(self):
+        """
+        Retain the current Proxy of an existing Host, unless unbalanced.
+        """
+
+        proxies = [{'proxyid': '1', 'hosts': 10}, {'proxyid': '2', 'hosts': 9}]
+        self.assertEqual(select_proxy(INSTANCE, proxies, current='1'), '1')
+        self.assertEqual(select_proxy(INSTANCE, PROXIES, current='3'), '2')
+
+        # rebalance onto a newly added proxy
+        proxies = PROXIES[:2] + [{'proxyid': '4', 'hosts': 0}]
+        self.assertEqual(select_proxy(INSTANCE, proxies, current='1'), '4')
+
+    def test_100_proxy_diff(self):
+        """
+        Diff the Proxy assignment of a Host only if desired.
+        """
+
+        current = instance_to_host(INSTANCE)
+        current['hostid'] = '10001'
+        current['proxy_hostid'] = '0'
+        self.assertIsNone(host_diff(current, instance_to_host(INSTANCE)))
+
+        desired = instance_to_host(INSTANCE, proxy_hostid='2')
+        self.assertEqual(host_diff(current, desired)['proxy_hostid'], '2')
+
+        current['proxy_hostid'] = '2'
+        self.assertIsNone(host_diff(current, desired))
@@ -6,7 +6,7 @@ objects.
 def get_tag_by_key(instance, key):
     """Returns the value of the given EC2 Instance Tag or None"""
 
-    for tag in instance['Tags']:
+    for tag in instance.get('Tags', []):
         if key == tag['Key']:
             return tag['Value']
 
@@ -37,7 +37,56 @@ def state_to_status(state):
 
     raise ValueError('Unrecognised EC2 state: {}'.format(state))
 
-def instance_to_host(instance, groups=None, templates=None, macros=None):
+def select_proxy(instance, proxies, current=None, affinity=None, tolerance=0.2):
+    """
+    select_proxy returns the ID of the Zabbix Proxy from the given pool that
+    should monitor the given EC2 Instance, or None if no Proxy is eligible.
+
+    Each Proxy in the pool must be a dict with a 'proxyid' and the number of
+    'hosts' it currently monitors. If affinity is 'az' or 'vpc', only Proxies
+    with a matching (or undefined) 'availability_zone' or 'vpc_id' are eligible.
+
+    The least loaded eligible Proxy is selected, unless the current Proxy is
+    still eligible. A Host only moves off its current Proxy if that Proxy
+    monitors more than (n + 1) * (1 + tolerance) Hosts, where n is the number
+    of Hosts monitored by the least loaded alternative. This keeps Hosts
+    sticky, but migrates them gradually onto new Proxies as they are added to
+    the pool.
+    """
+
+    if affinity == 'az':
+        key, value = 'availability_zone', instance['Placement']['AvailabilityZone']
+    elif affinity == 'vpc':
+        key, value = 'vpc_id', instance['VpcId']
+    elif affinity is None:
+        key, value = None, None
+    else:
+        raise ValueError('Unrecognised proxy affinity: {}'.format(affinity))
+
+    eligible = [proxy for proxy in proxies
+                if key is None or proxy.get(key) in (None, value)]
+    if not eligible:
+        return None
+
+    current = str(current) if current not in (None, '0', 0) else None
+    others = [proxy for proxy in eligible if proxy['proxyid'] != current]
+    if len(others) == len(eligible):
+        # not currently monitored by an eligible proxy
+        return min(eligible, key=lambda x: (x['hosts'], x['proxyid']))['proxyid']
+
+    if not others:
+        return current
+
+    # stay put unless the pool is sufficiently unbalanced
+    target = min(others, key=lambda x: (x['hosts'], x['proxyid']))
+    load = [proxy['hosts'] for proxy in eligible if proxy['proxyid'] == current][0]
+    if load > (target['hosts'] + 1) * (1 + tolerance):
+        return target['proxyid']
+
+    return current
+
+def instance_to_host(instance, groups=None, templates=None, macros=None,
+                     proxy_hostid=None):
     """Converts the given EC2 Instance to a Zabbix Host"""
 
     status = state_to_status(instance['State']['Name'])
@@ -72,8 +121,12 @@ def instance_to_host(instance, groups=None, templates=None, macros=None):
         'macros': macros
     }
 
-    # append tags as macros
-    for tag in instance['Tags']:
+    # a proxy_hostid of '0' unassigns the Host from any Zabbix Proxy
+    if proxy_hostid is not None:
+        host['proxy_hostid'] = str(proxy_hostid)
+
+    # append tags as macros (describe-instances omits Tags if there are none)
+    for tag in instance.get('Tags', []):
         key = tag['Key'].lower()
         if key == 'name':
             host['name'] = '{} ({})'.format(tag['Value'], instance['InstanceId'])
@@ -111,6 +164,17 @@ def host_diff(current, desired):
             is_diff = True
             diff[field] = val_b
 
+    # diff proxy assignment
+    # NOTE: proxy_hostid is only compared if the desired state defines it, so
+    # that Hosts keep any manually configured Proxy if no Proxy pool is
+    # configured. With a pool, Hosts are moved onto a Proxy in the pool.
+    if 'proxy_hostid' in desired:
+        val_a = str(current.get('proxy_hostid', '0'))
+        val_b = str(desired['proxy_hostid'])
+        if val_a != val_b:
+            is_diff = True
+            diff['proxy_hostid'] = val_b
+
     # diff inventory items
     for item in desired['inventory']:
         if (item not in current['inventory'] or